@@ -2,16 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import math
-import json
-import numbers
-import re
+import hashlib
+import itertools
 import sys
-from typing import Any, Dict, NamedTuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple
 
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from bson import ObjectId
 from loguru import logger
-from pymongo import InsertOne, MongoClient, UpdateOne
+from pymongo import MongoClient, UpdateOne
 from pymongo.errors import BulkWriteError, PyMongoError, OperationFailure # Import OperationFailure
 from pymongo.write_concern import WriteConcern
 
@@ -22,7 +27,7 @@ logger.add("mongo_loader.log", rotation="500 KB", retention="5 days", level="INF
 patient_schema = {
     "bsonType": "object",
     "title": "Patient Validation",
-    "required": ["Name", "Age", "Gender", "Blood Type", "Medical Condition"],
+    "required": ["Name", "Age", "Gender", "Blood Type", "Medical Condition", "key_hash"],
     "properties": {
         "Name":  {"bsonType": "string"},
         "Age":   {"bsonType": "int", "minimum": 0, "maximum": 125},
@@ -39,6 +44,7 @@ patient_schema = {
             "enum": ["Cancer", "Obesity", "Diabetes",
                      "Asthma", "Hypertension", "Arthritis"]
         },
+        "key_hash": {"bsonType": "binData"},
     },
 }
 
@@ -87,7 +93,7 @@ billing_schema = {
 
 # ───────────────────────── validation constants ─────────────────────
 class C(NamedTuple):
-    PATIENT_KEY_FIELDS = tuple(patient_schema["properties"].keys())
+    PATIENT_KEY_FIELDS = ("Name", "Age", "Gender", "Blood Type", "Medical Condition")
     TEXT_CLEAN_COLS = (
     "Name", "Doctor", "Hospital", "Insurance Provider",
     "Medication",  # optional
@@ -102,55 +108,189 @@ class C(NamedTuple):
     )
 
 # ────────────────────────── helpers & regexes ───────────────────────
-NULL_LIKE_STRING_RE = re.compile(r"(?i)^(?:nan|none|null|n/?a|--|<na>)?$")
-
-
-def _is_int_like(x) -> bool:
-    if pd.isna(x) or isinstance(x, bool):
-        return False
-    if isinstance(x, numbers.Integral):
-        return True
-    return isinstance(x, numbers.Real) and math.isfinite(x) and float(x).is_integer()
-
-
-def build_key_tuple(row: pd.Series) -> frozenset:
-    return frozenset(
-        {
-            "Name": row["Name"],
-            "Age": int(row["Age"]),
-            "Gender": row["Gender"],
-            "Blood Type": row["Blood Type"],
-            "Medical Condition": row["Medical Condition"],
-        }.items()
+# Matched case-insensitively; kept flag-free so pandas can hand it to Arrow (RE2)
+NULL_LIKE_PATTERN = r"^(?:nan|none|null|n/?a|--|<na>)?$"
+
+# Arrow-backed strings: .str.* methods dispatch to Arrow's UTF-8 kernels
+ARROW_STRING = pd.StringDtype("pyarrow")
+
+# Allowed enum values as Arrow arrays, built once for pc.is_in
+GENDER_VALUES = pa.array(sorted(C.GENDERS))
+BLOOD_TYPE_VALUES = pa.array(sorted(C.BLOOD_TYPES))
+MED_COND_VALUES = pa.array(sorted(C.MED_CONDS))
+
+# Coerced per cell after parsing: a bad value becomes null instead of failing the load
+CSV_NUMERIC_COLS = ("Age", "Room Number", "Billing Amount")
+CSV_DATE_COLS = ("Date of Admission", "Discharge Date")
+
+# Text accepted as a number (after trimming); anything else is nulled before the cast
+NUMERIC_PATTERN = r"^[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?$"
+
+# Explicit date format: never inferred from the first row of a chunk
+CSV_DATE_FORMAT = "%Y-%m-%d"
+
+# Arrow parses every known column as text; typed columns are coerced by _coerce_types()
+CSV_COLUMN_TYPES = {
+    c: pa.string() for c in (
+        "Name", "Gender", "Blood Type", "Medical Condition", "Doctor",
+        "Hospital", "Insurance Provider", "Admission Type", "Medication",
+        "Test Results", *CSV_NUMERIC_COLS, *CSV_DATE_COLS,
     )
+}
 
+# Arrow → pandas dtypes: nullable numerics and Arrow-backed strings
+PANDAS_TYPES = {
+    pa.int64(): pd.Int64Dtype(),
+    pa.float64(): pd.Float64Dtype(),
+    pa.string(): ARROW_STRING,
+}
 
-# ────────────────── vectorised patient validation ───────────────────
-def validate_patients(df: pd.DataFrame) -> pd.DataFrame:
-    name_ok = df["Name"].notna()
-
-    age = df["Age"]
-    age_ok = (
-        age.notna()
-        & (age % 1 == 0)
-        & age.between(0, 125, inclusive="both")
+# Bytes handed to each Arrow CSV parsing task
+CSV_BLOCK_SIZE = 32 << 20
+
+# Upper bound on documents sent in a single insert_many call
+MAX_DB_BATCH = 1_000
+
+# Threads running child-collection insert_many calls while the next chunk is parsed
+INSERT_WORKERS = 4
+
+# Upper bound on queued insert batches; parsing pauses once it is reached
+MAX_IN_FLIGHT = 2 * INSERT_WORKERS
+
+# Upper bound on key_hash → _id entries remembered across chunks (FIFO eviction)
+MAX_KEY_CACHE = 200_000
+
+
+def iter_csv_chunks(csv_path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Stream `csv_path` through Arrow's multi-threaded CSV reader and yield
+    DataFrames of at most `chunk_size` rows, typed by `_coerce_types`
+    (Float64 numerics, millisecond datetimes, Arrow-backed strings).
+    """
+    reader = pacsv.open_csv(
+        csv_path,
+        read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE, use_threads=True),
+        convert_options=pacsv.ConvertOptions(
+            column_types=CSV_COLUMN_TYPES,
+            strings_can_be_null=True,
+        ),
     )
+    for batch in reader:
+        table = _coerce_types(pa.Table.from_batches([batch]))
+        for start in range(0, table.num_rows, chunk_size):
+            yield table.slice(start, chunk_size).to_pandas(types_mapper=PANDAS_TYPES.get)
+
 
-    gender_ok = df["Gender"].isin(C.GENDERS)
-    blood_ok = df["Blood Type"].isin(C.BLOOD_TYPES)
-    cond_ok = df["Medical Condition"].isin(C.MED_CONDS)
+def _coerce_types(table: pa.Table) -> pa.Table:
+    """
+    Numeric and date columns from text with Arrow kernels, one pass per column
+    per record batch; unparseable cells become null instead of raising.
+    """
+    for c in CSV_NUMERIC_COLS:
+        if c in table.column_names:
+            text = pc.utf8_trim_whitespace(table[c])
+            ok = pc.match_substring_regex(text, NUMERIC_PATTERN)
+            numbers = pc.cast(pc.if_else(ok, text, pa.scalar(None, pa.string())), pa.float64())
+            table = table.set_column(table.schema.get_field_index(c), c, numbers)
+    for c in CSV_DATE_COLS:
+        if c in table.column_names:
+            dates = pc.strptime(
+                pc.utf8_trim_whitespace(table[c]),
+                format=CSV_DATE_FORMAT, unit="ms", error_is_null=True,
+            )
+            table = table.set_column(table.schema.get_field_index(c), c, dates)
+    return table
+
+
+def patient_key_hash(name, age, gender, blood_type, condition) -> bytes:
+    """16-byte BLAKE2b digest of the canonical JSON of the 5 patient key fields."""
+    canonical = orjson.dumps([name, age, gender, blood_type, condition])
+    return hashlib.blake2b(canonical, digest_size=16).digest()
+
+
+def valid_rooms(rooms: np.ndarray) -> Tuple[np.ndarray, List[int]]:
+    """
+    Vectorised Room Number check over a float64 column.
+
+    Returns a boolean mask (finite, integral, >= 1) and the room numbers as
+    native ints (0 where the mask is False), ready for BSON encoding.
+    """
+    with np.errstate(invalid="ignore"):
+        mask = np.isfinite(rooms) & (rooms >= 1) & (np.floor(rooms) == rooms)
+    values = np.where(mask, rooms, 0).astype(np.int64).tolist()
+    return mask, values
+
+
+def _cache_put(cache: Dict[bytes, Any], resolved: Dict[bytes, Any]) -> None:
+    """Add `resolved` to `cache`, evicting the oldest entries past MAX_KEY_CACHE."""
+    cache.update(resolved)
+    overflow = len(cache) - MAX_KEY_CACHE
+    if overflow > 0:
+        for h in list(itertools.islice(cache, overflow)):
+            del cache[h]
+
+
+def _arrow_col(s: pd.Series) -> pa.ChunkedArray:
+    """The column as an Arrow array (zero-copy for Arrow-backed dtypes)."""
+    arr = pa.array(s, from_pandas=True)
+    return arr if isinstance(arr, pa.ChunkedArray) else pa.chunked_array([arr])
 
-    valid_mask = name_ok & age_ok & gender_ok & blood_ok & cond_ok
-    valid_df = df.loc[valid_mask].copy()
 
-    valid_df["key_tuple"] = valid_df.apply(build_key_tuple, axis=1)
+def _datetimes(s: pd.Series) -> np.ndarray:
+    """
+    Object array of datetime.datetime (None for NaT), converted by Arrow, for BSON.
+
+    Cast to millisecond precision first (all BSON stores): timestamp[ns]
+    to_pylist() would box pandas Timestamps instead.
+    """
+    ms = pc.cast(_arrow_col(s), pa.timestamp("ms"), safe=False)
+    return np.array(ms.to_pylist(), dtype=object)
+
+
+# ────────────────── vectorised patient validation ───────────────────
+def validate_patients(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the boolean mask of valid patient rows and, aligned with the
+    kept rows, their `key_hash` values. No filtered copy of `df` is made.
+    """
+    # Arrow compute kernels over the Arrow-backed columns; Age is Float64
+    # after coercion, so it must be integral as well as within bounds.
+    name_ok = pc.is_valid(_arrow_col(df["Name"]))
+
+    age = _arrow_col(df["Age"])
+    age_ok = pc.and_(
+        pc.equal(pc.floor(age), age),
+        pc.and_(pc.greater_equal(age, 0), pc.less_equal(age, 125)),
+    )
+
+    gender_ok = pc.is_in(_arrow_col(df["Gender"]), value_set=GENDER_VALUES)
+    blood_ok = pc.is_in(_arrow_col(df["Blood Type"]), value_set=BLOOD_TYPE_VALUES)
+    cond_ok = pc.is_in(_arrow_col(df["Medical Condition"]), value_set=MED_COND_VALUES)
+
+    valid = name_ok
+    for ok in (age_ok, gender_ok, blood_ok, cond_ok):
+        valid = pc.and_kleene(valid, ok)
+    valid_mask = pc.fill_null(valid, False).to_numpy(zero_copy_only=False)
+
+    # one zip over the raw column arrays instead of a per-row Series
+    names = df.loc[valid_mask, "Name"].to_numpy()
+    ages = df.loc[valid_mask, "Age"].to_numpy(dtype=np.int64)
+    genders = df.loc[valid_mask, "Gender"].to_numpy()
+    bloods = df.loc[valid_mask, "Blood Type"].to_numpy()
+    conds = df.loc[valid_mask, "Medical Condition"].to_numpy()
+    key_hashes = np.fromiter(
+        (patient_key_hash(n, int(a), g, b, c)
+         for n, a, g, b, c in zip(names, ages, genders, bloods, conds)),
+        dtype=object,
+        count=len(names),
+    )
 
     logger.info(
         "Patient validation: kept {} of {} rows",
-        valid_df.shape[0],
+        len(key_hashes),
         df.shape[0],
     )
-    return valid_df
+    return valid_mask, key_hashes
 
 
 # ───────────────────────── Mongo-utility helpers ────────────────────
@@ -184,7 +324,7 @@ def create_schema(coll, schema):
     applied_options = coll.options()
     validator = applied_options.get("validator", {})
 
-    logger.info("Validator for collection '%s':\n%s", coll_name, json.dumps(validator, indent=2))
+    logger.info("Validator for collection '%s':\n%s", coll_name, orjson.dumps(validator, option=orjson.OPT_INDENT_2).decode())
     #print(coll.options())
     
     # Defensive: verify validator was applied (especially useful in testcontainers)
@@ -195,8 +335,114 @@ def create_schema(coll, schema):
 
 
 
+def insert_many_unordered(coll, docs, label="documents"):
+    """
+    Insert raw dicts in slices of `MAX_DB_BATCH` with ordered=False.
+
+    The server keeps going past a document rejected by the validator, so one
+    bad row only costs that row; failures are logged by their index in `docs`.
+    """
+    inserted = 0
+    for start in range(0, len(docs), MAX_DB_BATCH):
+        batch = docs[start:start + MAX_DB_BATCH]
+        try:
+            coll.insert_many(batch, ordered=False, bypass_document_validation=False)
+            inserted += len(batch)
+        except BulkWriteError as bwe:
+            inserted += bwe.details.get("nInserted", 0)
+            for err in bwe.details.get("writeErrors", []):
+                logger.error("{} insert failed (doc {}) - {}",
+                             label.capitalize(),
+                             start + err["index"],
+                             err["errmsg"])
+    if docs:
+        logger.success("Inserted {} of {} {}", inserted, len(docs), label)
+    return inserted
+
+
+def ordered_bulk_safe(coll, ops, label="documents") -> Dict[int, Any]:
+    """Run `ops` ordered; return {op index: _id} for every upserted op."""
+    try:
+        result = coll.bulk_write(ops, ordered=True, bypass_document_validation=False)
+        logger.success("Inserted/updated {} {}", len(ops), label)
+        return dict(result.upserted_ids)
+    except BulkWriteError as bwe:
+        # Get the index of the first operation that failed
+        first_error = bwe.details["writeErrors"][0]
+        idx = first_error["index"]
+        
+        logger.error("{} bulk interrupted (op {}/{}) - {}",
+                     label.capitalize(),
+                     idx,
+                     len(ops),
+                     first_error["errmsg"])
+
+        upserted = {u["index"]: u["_id"] for u in bwe.details.get("upserted", [])}
+
+        # Retry subsequent operations one by one
+        logger.info("Retrying remaining {} operations individually...", len(ops) - (idx + 1))
+        for pos in range(idx + 1, len(ops)):
+            try:
+                result = coll.bulk_write([ops[pos]], ordered=True, bypass_document_validation=False)
+                if result.upserted_ids:
+                    upserted[pos] = result.upserted_ids[0]
+            except BulkWriteError as single_err:
+                # Corrected logging call using {} placeholders
+                logger.error("Retry {} failed – {}", label, single_err)
+        return upserted
+
+
+def take_full_batches(buf: list) -> list:
+    """Pop and return the whole `MAX_DB_BATCH` slices at the front of `buf`."""
+    full = len(buf) - len(buf) % MAX_DB_BATCH
+    batch = buf[:full]
+    del buf[:full]
+    return batch
+
+
+def _reap(futures: List[Future]) -> List[Future]:
+    """Drop finished futures, re-raising the first worker exception."""
+    pending = []
+    for f in futures:
+        if f.done():
+            f.result()
+        else:
+            pending.append(f)
+    return pending
+
+
+def _migrate_patient_keys(patients) -> None:
+    """
+    Upgrade a Patients collection written before `key_hash` existed: drop the
+    legacy 5-field unique index and backfill `key_hash` where it is missing,
+    so the unique `key_hash` index can be built. No-op on a migrated collection.
+    """
+    legacy = "_".join(f"{f}_1" for f in C.PATIENT_KEY_FIELDS)
+    if legacy in patients.index_information():
+        patients.drop_index(legacy)
+        logger.info("Dropped legacy patient index {}", legacy)
+
+    backfilled = 0
+    ops: List[UpdateOne] = []
+    cursor = patients.find(
+        {"key_hash": {"$exists": False}},
+        {f: 1 for f in C.PATIENT_KEY_FIELDS},
+    )
+    for doc in cursor:
+        h = patient_key_hash(*(doc.get(f) for f in C.PATIENT_KEY_FIELDS))
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"key_hash": h}}))
+        if len(ops) == MAX_DB_BATCH:
+            backfilled += patients.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        backfilled += patients.bulk_write(ops, ordered=False).modified_count
+    if backfilled:
+        logger.info("Backfilled key_hash on {} existing patients", backfilled)
+
+
 def create_indexes(patients, admissions, medical, billing):
-    patients.create_index([(f, 1) for f in C.PATIENT_KEY_FIELDS], unique=True)
+    _migrate_patient_keys(patients)
+    patients.create_index([("key_hash", 1)], unique=True)
     admissions.create_index([("patient_id", 1), ("Date of Admission", 1)])
     medical.create_index([("patient_id", 1), ("Doctor", 1)])
     billing.create_index([("patient_id", 1), ("Billing Amount", 1)])
@@ -216,152 +462,199 @@ def load_data(
     Stream-load the CSV in `chunk_size` batches.
 
     * Patients               → bulk-UPSERT, **ordered=True** – stop on 1st error, retry remainder one-by-one
-    * Admissions / Medicals / Billings → bulk-INSERT, **ordered=True** – same “stop-&-replay” logic
+    * Admissions / Medicals / Billings → insert_many, **ordered=False**, in slices of `MAX_DB_BATCH`,
+      buffered across chunks so every call but the last one is a full batch,
+      and run on `INSERT_WORKERS` threads while the next chunk is processed
 
-    This way the DB never receives partially-validated documents.
+    Schema validation stays on for every write, so the DB never receives
+    partially-validated documents.
     """
-    def _ordered_bulk_safe(coll, ops, label="documents"):
-        try:
-            coll.bulk_write(ops, ordered=True, bypass_document_validation=False)
-            logger.success("Inserted/updated {} {}", len(ops), label)
-        except BulkWriteError as bwe:
-            # Get the index of the first operation that failed
-            first_error = bwe.details["writeErrors"][0]
-            idx = first_error["index"]
-            
-            logger.error("{} bulk interrupted (op {}/{}) - {}",
-                         label.capitalize(),
-                         idx,
-                         len(ops),
-                         first_error["errmsg"])
-
-            # Log details for all errors in the batch
-            for err in bwe.details.get("writeErrors", []):
-                failed_doc = err.get('op')
-                logger.error("💥 Failed document:\n{}", failed_doc)
-                logger.error("💥 Mongo validation error [op {}]: {}", err.get('index'), err.get('errmsg'))
-
-            # Retry subsequent operations one by one
-            logger.info("Retrying remaining {} operations individually...", len(ops) - (idx + 1))
-            for op in ops[idx + 1:]:
-                try:
-                    coll.bulk_write([op], ordered=True, bypass_document_validation=False)
-                except BulkWriteError as single_err:
-                    # Corrected logging call using {} placeholders
-                    logger.error("Retry {} failed – {}", label, single_err)
+    # key_hash → _id of patients already resolved during this load; repeated
+    # patients in later chunks skip both the upsert and the lookup
+    key_cache: Dict[bytes, Any] = {}
+
+    # child docs accumulate across chunks until a full MAX_DB_BATCH is ready
+    pending = (
+        (admission_coll, [], "admissions"),
+        (medical_coll,   [], "medical records"),
+        (billing_coll,   [], "billing entries"),
+    )
 
     logger.info("Loading CSV from %s", csv_path)
 
-    for df in pd.read_csv(csv_path, chunksize=chunk_size):
-        # ───── numeric conversions ─────
-        df["Date of Admission"] = pd.to_datetime(df["Date of Admission"], errors="coerce")
-        df["Discharge Date"]   = pd.to_datetime(df["Discharge Date"],   errors="coerce")
-        df["Age"]         = df["Age"].astype(pd.Int64Dtype())
-        df["Room Number"] = df["Room Number"].astype(pd.Int64Dtype())
-        df["Billing Amount"] = pd.to_numeric(df["Billing Amount"], errors="coerce")
-
-        # ───── text cleaning ─────
-        txt_cols = [c for c in C.TEXT_CLEAN_COLS if c in df.columns]
-        df[txt_cols] = (
-            df[txt_cols]
-              .astype(str)
-              .apply(lambda s: s.str.strip())
-              .replace(NULL_LIKE_STRING_RE, None, regex=True)
-        )
-        if "Blood Type" in df.columns:
-            df["Blood Type"] = df["Blood Type"].str.upper()
-        if "Gender" in df.columns:
-            df["Gender"] = df["Gender"].str.capitalize()
-        title_cols = [
-            c for c in (
-                "Name", "Doctor", "Hospital", "Insurance Provider",
-                "Medication", "Admission Type", "Medical Condition", "Test Results"
-            ) if c in df.columns
-        ]
-        if title_cols:
-            df[title_cols] = df[title_cols].apply(lambda s: s.str.title())
-
-        # ───── validate patients ─────
-        valid_patients = validate_patients(df)
-        if valid_patients.empty:
-            logger.warning("No valid patients in this chunk – skipped")
-            continue
-
-        # ───── bulk-UPSERT patients (ordered) ─────
-        patient_docs = []
-        for _, row in valid_patients.iterrows():
-            patient_docs.append({
-                "Name": row["Name"],
-                "Age": int(row["Age"]),  # Force native int
-                "Gender": row["Gender"],
-                "Blood Type": row["Blood Type"],
-                "Medical Condition": row["Medical Condition"]
-            })
-
-        patient_upserts = [
-            UpdateOne(doc, {"$setOnInsert": doc}, upsert=True)
-            for doc in patient_docs
-        ]
-        _ordered_bulk_safe(patient_coll, patient_upserts, "patients")
-
-        # ───── map key → _id ─────
-        key_to_oid: Dict[frozenset, Any] = {}
-        for doc in patient_coll.find(
-            {"$or": [dict(k) for k in valid_patients["key_tuple"].unique()]},
-            {"_id": 1, **{k: 1 for k in C.PATIENT_KEY_FIELDS}},
-        ):
-            kt = frozenset({k: doc[k] for k in C.PATIENT_KEY_FIELDS}.items())
-            key_to_oid[kt] = doc["_id"]
-        valid_patients["patient_oid"] = valid_patients["key_tuple"].map(key_to_oid)
-        valid_patients = valid_patients[valid_patients["patient_oid"].notna()].copy()
-        valid_patients.drop_duplicates(subset=C.PATIENT_KEY_FIELDS, inplace=True)
-
-        # ✅ Drop forbidden internal fields before building docs
-        valid_patients = valid_patients.drop(columns=["key_tuple"], errors="ignore")
-
-        # ───── build child document ops ─────
-        admissions, medicals, billings = [], [], []
-        for _, r in valid_patients.iterrows():
-            pid = r["patient_oid"]
-
-            # Admission
-            if pd.notna(r["Date of Admission"]) and pd.notna(r["Admission Type"]):
-                room = int(r["Room Number"]) if _is_int_like(r["Room Number"]) and r["Room Number"] >= 1 else None
-                admissions.append(
-                    InsertOne({
-                        "patient_id": pid,
-                        "Date of Admission": r["Date of Admission"],
-                        "Admission Type":  r["Admission Type"],
-                        "Room Number":     room,
-                        "Discharge Date":  r["Discharge Date"],
-                    })
+    in_flight: List[Future] = []
+    with ThreadPoolExecutor(max_workers=INSERT_WORKERS) as executor:
+        for df in iter_csv_chunks(csv_path, chunk_size):
+            # ───── text cleaning ─────
+            txt_cols = [c for c in C.TEXT_CLEAN_COLS if c in df.columns]
+            title_cols = [
+                c for c in (
+                    "Name", "Doctor", "Hospital", "Insurance Provider",
+                    "Medication", "Admission Type", "Medical Condition", "Test Results"
+                ) if c in df.columns
+            ]
+            for c in txt_cols:
+                s = df[c].str.strip()
+                df[c] = s.mask(s.str.match(NULL_LIKE_PATTERN, case=False, na=False))
+            if "Blood Type" in df.columns:
+                df["Blood Type"] = df["Blood Type"].str.upper()
+            if "Gender" in df.columns:
+                df["Gender"] = df["Gender"].str.capitalize()
+            # Arrow-backed .str methods run pc.utf8_* kernels; per column, no frame-wide apply
+            for c in title_cols:
+                df[c] = df[c].str.title()
+
+            # ───── validate patients ─────
+            valid_mask, key_hashes = validate_patients(df)
+            if not valid_mask.any():
+                logger.warning("No valid patients in this chunk – skipped")
+                continue
+            valid_patients = df.loc[valid_mask]
+
+            # ───── bulk-UPSERT patients (ordered) ─────
+            # One upsert per distinct key not seen earlier in this load, each
+            # carrying a client-generated _id: for newly inserted patients the
+            # id is known without a read-back.
+            first = ~pd.Index(key_hashes).duplicated()
+            cached = np.fromiter((h in key_cache for h in key_hashes), dtype=bool,
+                                 count=len(key_hashes))
+            key_to_oid: Dict[bytes, Any] = {
+                h: key_cache[h] for h in key_hashes[first & cached]
+            }
+
+            todo = np.flatnonzero(first & ~cached)
+            hashes = key_hashes[todo]
+            names   = valid_patients["Name"].to_numpy()
+            ages    = valid_patients["Age"].to_numpy(dtype=np.int64)
+            genders = valid_patients["Gender"].to_numpy()
+            bloods  = valid_patients["Blood Type"].to_numpy()
+            conds   = valid_patients["Medical Condition"].to_numpy()
+            # key_hash is not repeated in $setOnInsert: an upsert seeds the
+            # new document with the filter's equality fields
+            patient_upserts = [
+                UpdateOne(
+                    {"key_hash": key_hashes[i]},
+                    {"$setOnInsert": {
+                        "Name": names[i],
+                        "Age": int(ages[i]),  # Force native int
+                        "Gender": genders[i],
+                        "Blood Type": bloods[i],
+                        "Medical Condition": conds[i],
+                        "_id": ObjectId(),
+                    }},
+                    upsert=True,
                 )
-
-            # Medical record
-            if pd.notna(r["Doctor"]) and pd.notna(r["Hospital"]):
-                medicals.append(
-                    InsertOne({
-                        "patient_id": pid,
-                        "Doctor":     r["Doctor"],
-                        "Hospital":   r["Hospital"],
-                        "Medication": r["Medication"] if pd.notna(r["Medication"]) else None,
-                        "Test Results": r["Test Results"] if pd.notna(r["Test Results"]) else None,
-                    })
+                for i in todo
+            ]
+            upserted = (
+                ordered_bulk_safe(patient_coll, patient_upserts, "patients")
+                if patient_upserts else {}
+            )
+
+            # ───── map key_hash → _id ─────
+            # Upserted ops already know their _id; only pre-existing patients
+            # (upsert matched instead of inserting) need a lookup.
+            key_to_oid.update({hashes[i]: oid for i, oid in upserted.items()})
+            missing = [h for h in hashes if h not in key_to_oid]
+            if missing:
+                # first reply sized to hold every match: no getMore round-trips
+                cursor = patient_coll.find(
+                    {"key_hash": {"$in": missing}},
+                    {"_id": 1, "key_hash": 1},
+                    batch_size=len(missing),
+                    comment="loader key_hash lookup",
                 )
+                key_to_oid.update({doc["key_hash"]: doc["_id"] for doc in cursor})
+            _cache_put(key_cache, key_to_oid)
+            pids = np.fromiter((key_to_oid.get(h) for h in key_hashes), dtype=object,
+                               count=len(key_hashes))
+            # resolved patients only, first row per key_hash (one hashed column
+            # instead of a five-column drop_duplicates); folded into the child
+            # masks below rather than used to copy the frame again
+            keep = pd.notna(pids) & first
+
+            # ───── build child documents ─────
+            # Each column is pulled out once and null-checked once; the loops
+            # below only index into plain NumPy arrays.
+            adm_date_ok = valid_patients["Date of Admission"].notna().to_numpy()
+            adm_type_ok = valid_patients["Admission Type"].notna().to_numpy()
+            doctor_ok   = valid_patients["Doctor"].notna().to_numpy()
+            hosp_ok     = valid_patients["Hospital"].notna().to_numpy()
+            med_ok      = valid_patients["Medication"].notna().to_numpy()
+            test_ok     = valid_patients["Test Results"].notna().to_numpy()
+            insurer_ok  = valid_patients["Insurance Provider"].notna().to_numpy()
+
+            adm_dates = _datetimes(valid_patients["Date of Admission"])
+            dis_dates = _datetimes(valid_patients["Discharge Date"])
+            adm_types = valid_patients["Admission Type"].to_numpy()
+            doctors   = valid_patients["Doctor"].to_numpy()
+            hospitals = valid_patients["Hospital"].to_numpy()
+            meds      = valid_patients["Medication"].to_numpy()
+            tests     = valid_patients["Test Results"].to_numpy()
+            insurers  = valid_patients["Insurance Provider"].to_numpy()
+            rooms     = valid_patients["Room Number"].to_numpy(dtype=np.float64, na_value=np.nan)
+            amounts   = valid_patients["Billing Amount"].to_numpy(dtype=np.float64, na_value=np.nan)
+
+            room_ok, room_vals = valid_rooms(rooms)
+            amount_ok = ~np.isnan(amounts)
+
+            adm_mask  = keep & adm_date_ok & adm_type_ok
+            med_mask  = keep & doctor_ok & hosp_ok
+            bill_mask = keep & (amount_ok | insurer_ok)
+
+            admissions = [
+                {
+                    "patient_id":        pids[i],
+                    "Date of Admission": adm_dates[i],
+                    "Admission Type":    adm_types[i],
+                    "Room Number":       room_vals[i] if room_ok[i] else None,
+                    "Discharge Date":    dis_dates[i],
+                }
+                for i in np.flatnonzero(adm_mask)
+            ]
 
-            # Billing
-            if pd.notna(r["Billing Amount"]) or pd.notna(r["Insurance Provider"]):
-                bill_doc = {"patient_id": pid}
-                if pd.notna(r["Billing Amount"]):
-                    bill_doc["Billing Amount"] = float(r["Billing Amount"])
-                if pd.notna(r["Insurance Provider"]):
-                    bill_doc["Insurance Provider"] = r["Insurance Provider"]
-                billings.append(InsertOne(bill_doc))
+            medicals = [
+                {
+                    "patient_id":   pids[i],
+                    "Doctor":       doctors[i],
+                    "Hospital":     hospitals[i],
+                    "Medication":   meds[i] if med_ok[i] else None,
+                    "Test Results": tests[i] if test_ok[i] else None,
+                }
+                for i in np.flatnonzero(med_mask)
+            ]
 
-        # ───── ordered bulk-inserts for child docs ─────
-        _ordered_bulk_safe(admission_coll, admissions, "admissions")
-        _ordered_bulk_safe(medical_coll,   medicals,   "medical records")
-        _ordered_bulk_safe(billing_coll,   billings,   "billing entries")
+            billings = []
+            for i in np.flatnonzero(bill_mask):
+                bill_doc = {"patient_id": pids[i]}
+                if amount_ok[i]:
+                    bill_doc["Billing Amount"] = float(amounts[i])
+                if insurer_ok[i]:
+                    bill_doc["Insurance Provider"] = insurers[i]
+                billings.append(bill_doc)
+
+            # ───── buffer child docs, hand full batches to the pool ─────
+            for (coll, buf, label), docs in zip(pending, (admissions, medicals, billings)):
+                buf.extend(docs)
+                batch = take_full_batches(buf)
+                if batch:
+                    in_flight.append(
+                        executor.submit(insert_many_unordered, coll, batch, label)
+                    )
+            in_flight = _reap(in_flight)
+            # backpressure: parsing resumes only once fewer than MAX_IN_FLIGHT batches are queued
+            while len(in_flight) >= MAX_IN_FLIGHT:
+                wait(in_flight, return_when=FIRST_COMPLETED)
+                in_flight = _reap(in_flight)
+
+        # ───── flush what is left in the buffers ─────
+        for coll, buf, label in pending:
+            if buf:
+                in_flight.append(executor.submit(insert_many_unordered, coll, buf, label))
+
+    # pool is shut down (all inserts finished); surface any worker error
+    for f in in_flight:
+        f.result()
 
     logger.success("Data load complete")
 
@@ -375,20 +668,26 @@ def initialize_mongodb_users_and_roles(client: MongoClient, db_name: str):
     admin_db = client.admin
     target_db = client[db_name]
 
-    # 1. Create loaderRole
+    # 1. Create loaderRole (dropIndex: create_indexes drops the legacy patient index)
+    loader_privileges = [{
+        "resource": { "db": db_name, "collection": "" },
+        "actions": ["find","insert", "update", "createIndex", "dropIndex", "collMod", "listCollections", "listIndexes"]
+    }]
     try:
         admin_db.command({
             "createRole": "loaderRole",
-            "privileges": [{
-                "resource": { "db": db_name, "collection": "" },
-                "actions": ["find","insert", "update", "createIndex", "collMod", "listCollections", "listIndexes"]
-            }],
+            "privileges": loader_privileges,
             "roles": []
         })
         logger.success("Role 'loaderRole' created.")
     except OperationFailure as e:
         if "already exists" in str(e):
-            logger.info("Role 'loaderRole' already exists. Skipping creation.")
+            # Roles created by earlier versions lack newer actions; granting is idempotent
+            admin_db.command({
+                "grantPrivilegesToRole": "loaderRole",
+                "privileges": loader_privileges,
+            })
+            logger.info("Role 'loaderRole' already exists. Privileges brought up to date.")
         else:
             raise
 
@@ -485,7 +784,8 @@ if __name__ == "__main__":
 
         # --- Step 2: Connect as the 'loader' user for data loading ---
         # Now connect using the loader user, which should now exist
-        client = MongoClient(args.mongo_uri, tz_aware=False)
+        # zstd-compressed wire protocol (zlib fallback): bulk payloads are repetitive text
+        client = MongoClient(args.mongo_uri, tz_aware=False, compressors="zstd,zlib")
         client.admin.command("ping") # Ping to ensure connection with the loader user
         logger.success("MongoDB connection OK as 'loader' user.")
 
@@ -7,13 +7,20 @@ Pytest suite for 'healthcare_mongo_loader_optimized.py' (v2)
 • Validates: cleaning, typing, dedup, children-inserts, indexes
 """
 
+import os
+import threading
+import time
 from pathlib import Path
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import pytest
+from bson import ObjectId
 from loguru import logger
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from testcontainers.mongodb import MongoDbContainer
 
 # ─── CUT under test ──────────────────────────────────────────────────────────
@@ -26,38 +33,61 @@ from app import healthcare_mongo_loader_optimized as CUT
 # ───────────────────── fixtures ──────────────────────────────────────────────
 @pytest.fixture(scope="session")
 def mongo_client():
-    """A real MongoDB instance running in a Docker container."""
+    """
+    A real MongoDB instance running in a Docker container, or the long-lived
+    server at $TEST_MONGO_URI when set (skips the container boot on reruns).
+    """
+    uri = os.environ.get("TEST_MONGO_URI")
+    if uri:
+        yield MongoClient(uri)
+        return
     with MongoDbContainer("mongo:7.0.7") as container:
         yield MongoClient(container.get_connection_url())
 
 
 @pytest.fixture(scope="session")
 def db_name():
-    return "UnitTestDB"
+    """Per-worker database so parallel (pytest-xdist) runs never share collections."""
+    return f"UnitTestDB_{os.environ.get('PYTEST_XDIST_WORKER', 'gw0')}"
+
+
+@pytest.fixture(scope="session")
+def schema_once(mongo_client, db_name):
+    """
+    Applies validators and indexes to all four collections once per session
+    and returns them; tests only ever reset their data.
+    """
+    colls = tuple(
+        CUT.get_collection(mongo_client, db_name, name)
+        for name in ("Patients", "Admissions", "MedicalRecords", "Billing")
+    )
+    for coll, schema in zip(colls, (
+        CUT.patient_schema,
+        CUT.admission_schema,
+        CUT.medical_record_schema,
+        CUT.billing_schema,
+    )):
+        CUT.create_schema(coll, schema)
+    CUT.create_indexes(*colls)
+    return colls
 
 
 @pytest.fixture
-def collections(mongo_client, db_name):
+def collections(schema_once):
     """
     Provides a tuple of all collections and ensures they are empty
     before each test runs, guaranteeing test isolation.
     """
-    colls = (
-        CUT.get_collection(mongo_client, db_name, "Patients"),
-        CUT.get_collection(mongo_client, db_name, "Admissions"),
-        CUT.get_collection(mongo_client, db_name, "MedicalRecords"),
-        CUT.get_collection(mongo_client, db_name, "Billing"),
-    )
-    # Clean collections before the test to ensure a clean slate
-    for coll in colls:
+    # delete_many keeps the session's validators and indexes in place
+    for coll in schema_once:
         coll.delete_many({})
-    yield colls
+    yield schema_once
 
 
-@pytest.fixture
-def csv_sample(tmp_path: Path) -> Path:
-    """A 2-row valid CSV."""
-    df = pd.DataFrame(
+@pytest.fixture(scope="session")
+def sample_df() -> pd.DataFrame:
+    """The 2 valid rows behind `csv_sample`; derive variants from a copy."""
+    return pd.DataFrame(
         {
             "Name": ["John Doe", "Jane Smith"],
             "Age": [35, 42],
@@ -76,8 +106,13 @@ def csv_sample(tmp_path: Path) -> Path:
             "Test Results": ["Normal", "Abnormal"],
         }
     )
-    p = tmp_path / "patients.csv"
-    df.to_csv(p, index=False)
+
+
+@pytest.fixture(scope="session")
+def csv_sample(sample_df: pd.DataFrame, tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """A 2-row valid CSV, written once per session (tests only read it)."""
+    p = tmp_path_factory.mktemp("csv") / "patients.csv"
+    pacsv.write_csv(pa.Table.from_pandas(sample_df, preserve_index=False), p)
     return p
 
 
@@ -95,50 +130,258 @@ def test_schema_and_index_creation(collections):
 
     CUT.create_indexes(patients, admissions, medical, billing)
 
-    # Index existence
-    idx_names = patients.index_information()
-    assert any(v.get("unique") for v in idx_names.values()), "Unique index absent on Patients"
+    # The patient dedup key must be backed by its own unique index
+    idx_info = patients.index_information()
+    assert idx_info.get("key_hash_1", {}).get("unique") is True, "Unique key_hash index absent on Patients"
 
 
-def test_full_load_happy_path(collections, csv_sample):
+def test_legacy_patients_are_migrated(collections, csv_sample):
     patients, admissions, medical, billing = collections
 
-    # Apply schemas
-    for coll, schema in (
-        (patients, CUT.patient_schema),
-        (admissions, CUT.admission_schema),
-        (medical, CUT.medical_record_schema),
-        (billing, CUT.billing_schema),
-    ):
-        CUT.create_schema(coll, schema)
+    # A Patients collection as the 5-field-key loader left it
+    patients.drop_index("key_hash_1")
+    patients.create_index([(f, 1) for f in CUT.C.PATIENT_KEY_FIELDS], unique=True)
+    legacy_id = patients.insert_one(
+        {"Name": "John Doe", "Age": 35, "Gender": "Male",
+         "Blood Type": "A+", "Medical Condition": "Diabetes"},
+        bypass_document_validation=True,
+    ).inserted_id
 
     CUT.create_indexes(patients, admissions, medical, billing)
 
+    idx_info = patients.index_information()
+    assert set(idx_info) == {"_id_", "key_hash_1"}
+    john = patients.find_one({"_id": legacy_id}, {"key_hash": 1})
+    assert john["key_hash"] == CUT.patient_key_hash("John Doe", 35, "Male", "A+", "Diabetes")
+
+    # Reloading matches the legacy patient instead of duplicating it
+    CUT.load_data(str(csv_sample), patients, admissions, medical, billing)
+
+    assert patients.estimated_document_count() == 2
+    assert admissions.count_documents({"patient_id": legacy_id}) == 1
+
+
+def test_patient_key_hash_is_stable():
+    key = ("John Doe", 35, "Male", "A+", "Diabetes")
+
+    h = CUT.patient_key_hash(*key)
+
+    assert isinstance(h, bytes) and len(h) == 16
+    assert h == CUT.patient_key_hash(*key)
+    assert h != CUT.patient_key_hash("John Doe", 36, "Male", "A+", "Diabetes")
+
+
+def test_valid_rooms_mask_and_values():
+    rooms = np.array([305.0, 0.0, 12.5, np.nan, np.inf, 1.0])
+
+    mask, values = CUT.valid_rooms(rooms)
+
+    assert mask.tolist() == [True, False, False, False, False, True]
+    assert values[0] == 305 and values[5] == 1
+    assert all(isinstance(v, int) for v in values)
+
+
+def test_datetimes_are_plain_datetimes():
+    s = pd.Series(pd.to_datetime(["2023-01-15 10:30:00.123456", None]))
+
+    out = CUT._datetimes(s)
+
+    assert type(out[0]) is datetime
+    assert out[0] == datetime(2023, 1, 15, 10, 30, 0, 123000)
+    assert out[1] is None
+
+
+def test_full_load_happy_path(collections, csv_sample):
+    patients, admissions, medical, billing = collections
+
     CUT.load_data(
         csv_path=str(csv_sample),
         patient_coll=patients,
         admission_coll=admissions,
         medical_coll=medical,
         billing_coll=billing,
-        chunk_size=1,  # force several chunks
     )
 
     # 2 patients, 2 admissions, 2 medicals, 2 billings expected
-    assert patients.count_documents({}) == 2
-    assert admissions.count_documents({}) == 2
-    assert medical.count_documents({}) == 2
-    assert billing.count_documents({}) == 2
+    assert patients.estimated_document_count() == 2
+    assert admissions.estimated_document_count() == 2
+    assert medical.estimated_document_count() == 2
+    assert billing.estimated_document_count() == 2
 
-    jd = patients.find_one({"Name": "John Doe"})
+    jd = patients.find_one({"Name": "John Doe"}, {"Age": 1, "Gender": 1, "Blood Type": 1})
     assert isinstance(jd["Age"], int) and jd["Age"] == 35
     assert jd["Gender"] == "Male"
     assert jd["Blood Type"] == "A+"
 
-    ad = admissions.find_one({"patient_id": jd["_id"]})
+    ad = admissions.find_one(
+        {"patient_id": jd["_id"]}, {"Room Number": 1, "Date of Admission": 1}
+    )
     assert ad["Room Number"] == 305
     assert isinstance(ad["Date of Admission"], datetime)
 
 
+@pytest.mark.parametrize("chunk_size", [1, 2, 5])
+def test_batching_boundary(collections, csv_sample, chunk_size):
+    """Chunk sizes below, equal to and above the row count load the same docs."""
+    patients, admissions, medical, billing = collections
+
+    CUT.load_data(str(csv_sample), patients, admissions, medical, billing, chunk_size=chunk_size)
+
+    for coll in collections:
+        assert coll.estimated_document_count() == 2
+
+
+@pytest.mark.parametrize(
+    "column, value, expected_admissions",
+    [
+        ("Age", "30.0", 2),
+        ("Billing Amount", "abc", 2),
+        ("Date of Admission", "not a date", 1),
+        ("Date of Admission", "01/15/2023", 1),
+    ],
+)
+def test_malformed_cell_does_not_abort_load(
+    collections, sample_df, tmp_path: Path, column, value, expected_admissions
+):
+    """One unparseable cell only nulls that value; every row still loads."""
+    patients, admissions, medical, billing = collections
+
+    df = sample_df.astype({column: object})
+    df.loc[0, column] = value
+    p = tmp_path / "malformed.csv"
+    df.to_csv(p, index=False)
+
+    CUT.load_data(str(p), patients, admissions, medical, billing)
+
+    assert patients.estimated_document_count() == 2
+    assert admissions.estimated_document_count() == expected_admissions
+    assert medical.estimated_document_count() == 2
+    assert billing.estimated_document_count() == 2
+
+    # row 1 is untouched: its admission must survive whatever row 0 holds
+    jane = patients.find_one({"Name": "Jane Smith"}, {"_id": 1})
+    assert admissions.count_documents({"patient_id": jane["_id"]}) == 1
+
+
+def test_rejected_child_does_not_stop_its_batch(collections, sample_df, tmp_path: Path):
+    patients, admissions, medical, billing = collections
+
+    # First admission of the batch breaks the Admission Type enum
+    df = pd.concat([sample_df, sample_df.iloc[[0]].assign(Name="Jim Beam")], ignore_index=True)
+    df.loc[0, "Admission Type"] = "Transfer"
+    p = tmp_path / "transfer.csv"
+    df.to_csv(p, index=False)
+
+    CUT.load_data(str(p), patients, admissions, medical, billing)
+
+    assert patients.estimated_document_count() == 3
+    assert admissions.estimated_document_count() == 2
+    assert medical.estimated_document_count() == 3
+    assert billing.estimated_document_count() == 3
+    assert admissions.count_documents({"Admission Type": "Transfer"}) == 0
+
+
+def _patient_upsert(name: str, gender: str = "Male"):
+    """An upsert as load_data builds it, plus the _id it would insert."""
+    oid = ObjectId()
+    doc = {"Name": name, "Age": 40, "Gender": gender,
+           "Blood Type": "O+", "Medical Condition": "Asthma", "_id": oid}
+    key = CUT.patient_key_hash(name, 40, gender, "O+", "Asthma")
+    return UpdateOne({"key_hash": key}, {"$setOnInsert": doc}, upsert=True), oid
+
+
+def test_ordered_bulk_recovers_upserted_ids(collections):
+    patients = collections[0]
+    existing, existing_id = _patient_upsert("Dana Scully")
+    CUT.ordered_bulk_safe(patients, [existing])
+
+    ok_before, id_before = _patient_upsert("Fox Mulder")
+    rejected, _ = _patient_upsert("Bad Gender", gender="Alien")  # fails the validator
+    ok_after, id_after = _patient_upsert("Walter Skinner")
+    matched, _ = _patient_upsert("Dana Scully")                  # already there
+
+    upserted = CUT.ordered_bulk_safe(patients, [ok_before, rejected, ok_after, matched])
+
+    # op 0 comes from the BulkWriteError details, op 2 from the one-by-one retry;
+    # the rejected op and the matched (not upserted) op have no entry
+    assert upserted == {0: id_before, 2: id_after}
+    assert patients.estimated_document_count() == 3
+    assert patients.find_one({"Name": "Dana Scully"}, {"_id": 1})["_id"] == existing_id
+
+
+class _SlowInserts:
+    """Child collection stub whose insert_many is slower than parsing a chunk."""
+
+    def __init__(self, done: list, lock: threading.Lock):
+        self.done, self.lock = done, lock
+
+    def insert_many(self, docs, **kwargs):
+        time.sleep(0.05)
+        with self.lock:
+            self.done[0] += 1
+
+
+def test_in_flight_inserts_are_bounded(collections, sample_df, tmp_path: Path, monkeypatch):
+    patients = collections[0]
+    monkeypatch.setattr(CUT, "MAX_DB_BATCH", 1)     # one batch per child doc
+    monkeypatch.setattr(CUT, "MAX_IN_FLIGHT", 2)
+
+    df = pd.concat([sample_df.iloc[[0]]] * 12, ignore_index=True)
+    df["Name"] = [f"Patient {i}" for i in range(12)]
+    p = tmp_path / "slow.csv"
+    df.to_csv(p, index=False)
+
+    # queued = batches handed to the pool - batches the stub has finished
+    lock, done, submitted, peak = threading.Lock(), [0], [0], [0]
+    real_take = CUT.take_full_batches
+
+    def counting_take(buf):
+        batch = real_take(buf)
+        if batch:
+            with lock:
+                submitted[0] += 1
+                peak[0] = max(peak[0], submitted[0] - done[0])
+        return batch
+
+    monkeypatch.setattr(CUT, "take_full_batches", counting_take)
+    slow = _SlowInserts(done, lock)
+
+    CUT.load_data(str(p), patients, slow, slow, slow, chunk_size=1)
+
+    # a chunk starts with < MAX_IN_FLIGHT queued and adds at most one batch per
+    # child collection; an unbounded queue would reach ~2 per chunk parsed
+    assert peak[0] <= CUT.MAX_IN_FLIGHT + 2
+    assert done[0] == 3 * 12
+
+
+def test_repeated_patient_across_chunks(collections, sample_df, tmp_path: Path, monkeypatch):
+    patients, admissions, medical, billing = collections
+
+    # Same patient twice, split over two chunks: second chunk hits the key cache
+    df = sample_df.iloc[[0, 0]].reset_index(drop=True)
+    df["Date of Admission"] = ["2023-01-15", "2023-06-01"]
+    p = tmp_path / "repeat.csv"
+    df.to_csv(p, index=False)
+
+    calls = []
+    for method in ("bulk_write", "find"):
+        real = getattr(patients, method)
+        monkeypatch.setattr(
+            patients, method,
+            lambda *a, _m=method, _real=real, **kw: calls.append(_m) or _real(*a, **kw),
+        )
+
+    CUT.load_data(str(p), patients, admissions, medical, billing, chunk_size=1)
+
+    # chunk 1 upserts the patient (its _id comes back in upserted_ids, no find);
+    # chunk 2 resolves it from the cache: no second upsert, no lookup
+    assert calls == ["bulk_write"]
+    monkeypatch.undo()
+    assert patients.estimated_document_count() == 1
+    pid = patients.find_one({}, {"_id": 1})["_id"]
+    assert admissions.count_documents({"patient_id": pid}) == 2
+
+
 def test_invalid_rows_are_dropped(collections, tmp_path: Path):
     patients, admissions, medical, billing = collections
     
@@ -165,33 +408,23 @@ def test_invalid_rows_are_dropped(collections, tmp_path: Path):
     p = tmp_path / "bad.csv"
     df.to_csv(p, index=False)
 
-    for coll, schema in [
-        (patients, CUT.patient_schema),
-        (admissions, CUT.admission_schema),
-        (medical, CUT.medical_record_schema),
-        (billing, CUT.billing_schema),
-    ]:
-        CUT.create_schema(coll, schema)
-
     CUT.load_data(str(p), patients, admissions, medical, billing, chunk_size=5)
 
-    assert patients.count_documents({}) == 1
-    good = patients.find_one()
+    assert patients.estimated_document_count() == 1
+    good = patients.find_one({}, {"Name": 1})
     assert good["Name"] == "Good Guy"
 
 
 def test_duplicate_patient_is_upserted(collections, csv_sample):
     patients, admissions, medical, billing = collections
 
-    # Setup & first load
-    CUT.create_schema(patients, CUT.patient_schema)
-    CUT.create_indexes(patients, admissions, medical, billing)
+    # First load
     CUT.load_data(str(csv_sample), patients, admissions, medical, billing)
 
-    first_count = patients.count_documents({})
+    first_count = patients.estimated_document_count()
     assert first_count == 2
 
     # Load same file again – upsert must avoid duplicates
     CUT.load_data(str(csv_sample), patients, admissions, medical, billing)
 
-    assert patients.count_documents({}) == first_count
\ No newline at end of file
+    assert patients.estimated_document_count() == first_count
\ No newline at end of file